@@ -1,31 +1,92 @@
 \
 import re
 import os
+import io
+import functools
 import smtplib
 import sqlite3
 import ssl
 import yaml
 import pytz
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from lxml import etree
+from lxml import html as lxhtml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin, urlparse, urlsplit
 
-DB_PATH = "seen_listings.sqlite3"
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as _YamlLoader
 
+DB_PATH = "seen_listings.sqlite3"
+SQL_IN_CHUNK = 500  # stays under SQLITE_MAX_VARIABLE_NUMBER on old SQLite builds
+MAX_FETCH_WORKERS = 16
+FETCH_TIMEOUT = (5, 30)  # (connect, read) seconds
+
+# Shared across fetch threads so connections to the same host are reused
+SESSION = requests.Session()
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (compatible; TelAvivRentalBot/1.0)",
+    "Accept-Language": "he-IL,he;q=0.9,en;q=0.3",
+})
+_adapter = HTTPAdapter(
+    # Ignore Retry-After: a rate-limited site could otherwise stall the run for
+    # hours; after two quick retries the source is reported as an error instead
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        respect_retry_after_header=False,
+    ),
+    pool_connections=MAX_FETCH_WORKERS,
+    pool_maxsize=MAX_FETCH_WORKERS,
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Single alternation so each URL is scanned once rather than once per pattern
+_LISTING_RE = re.compile("|".join((
+    r"itemId=\d+",
+    r"/item/\d+",
+    r"/rent/\d+",
+    r"/realestate/item",
+    r"/realestate/rent/.+/\d+",
+    r"/nadlan/.+/\d+",
+)))
+# netloc and path+query of a plain absolute URL, without going through urlparse;
+# unusual hosts, path params (";") and control characters are left to urlparse
+_URL_PARTS_RE = re.compile(r"[A-Za-z]+://([\w.:@%~!$&'()*+,=-]*)([/?][^#;\t\r\n]*|)(?:#|$)", re.ASCII)
+_PRICE_RE = re.compile(r"(\d{3,6})\s*₪")
+_ROOMS_RE = re.compile(r"(\d+(?:\.\d)?)\s*חדר")
+_SIZE_RE = re.compile(r"(\d{2,4})\s*(?:מ\"ר|מטר)")
+_STYLE_URL_RE = re.compile(r'url\(["\']?([^"\')]+)["\']?\)')
+_BAD_IMAGE_TOKENS = ("placeholder", "icon", "logo", "avatar", "data:image")
+
+@functools.lru_cache(maxsize=1)
 def load_config(path="config.yaml"):
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_YamlLoader)
 
 def ensure_db():
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
+    cur.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+        PRAGMA mmap_size=268435456;
+    """)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS seen (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             source_name TEXT NOT NULL,
             listing_key TEXT NOT NULL UNIQUE,
             first_seen_at TEXT NOT NULL
@@ -34,78 +95,107 @@ def ensure_db():
     conn.commit()
     return conn
 
-def normalize_url(base_url, href):
+def _is_plain_href(href):
+    """True if urljoin would keep href's path, query and fragment verbatim."""
+    return (href[-1] not in "?#" and "/." not in href and "?#" not in href
+            and ";" not in href and "\t" not in href and "\n" not in href
+            and "\r" not in href)
+
+def normalize_url(base_url, href, base=None):
+    """Resolve href against base_url.
+
+    base may be urlsplit(base_url), computed once per page; it enables
+    string fast paths for absolute, protocol-relative and root-relative
+    hrefs that give the same result as urljoin.
+    """
     if not href:
         return None
     href = href.strip()
     if href.startswith("javascript:") or href.startswith("#"):
         return None
+    if base is not None and href and _is_plain_href(href):
+        if href[:1] == "/" and href[1:2] != "/":
+            return base.scheme + "://" + base.netloc + href
+        if href[:2] == "//":
+            absolute = base.scheme + ":" + href
+        elif href.startswith(base.scheme + "://"):
+            absolute = href
+        else:
+            absolute = None
+        # Only for a plain ASCII host; urljoin treats "//" + "/path" as
+        # relative and rejects malformed hosts
+        host_start = len(base.scheme) + 3
+        if (absolute and absolute.isascii()
+                and "[" not in absolute and "]" not in absolute
+                and absolute[host_start:host_start + 1] not in ("", "/", "?", "#")):
+            return absolute
     return urljoin(base_url, href)
 
 def is_listing_link(url, domain_hint):
     if not url:
         return False
-    parsed = urlparse(url)
-    if domain_hint and domain_hint not in parsed.netloc:
+    # Every listing pattern contains one of these; skip the parse and regex otherwise
+    if "item" not in url and "rent" not in url and "nadlan" not in url:
+        return False
+    m = _URL_PARTS_RE.match(url)
+    if m:
+        netloc, path_q = m.groups()
+    else:
+        parsed = urlparse(url)
+        netloc = parsed.netloc
+        path_q = (parsed.path or "") + "?" + (parsed.query or "")
+    if domain_hint and domain_hint not in netloc:
         return False
 
-    path_q = (parsed.path or "") + "?" + (parsed.query or "")
-    patterns = [
-        r"itemId=\d+",
-        r"/item/\d+",
-        r"/rent/\d+",
-        r"/realestate/item",
-        r"/realestate/rent/.+/\d+",
-        r"/nadlan/.+/\d+",
-    ]
-    return any(re.search(pat, path_q) for pat in patterns)
+    return bool(_LISTING_RE.search(path_q))
+
+def find_container(a_tag):
+    """Closest enclosing article/li/div of a link, or the link itself."""
+    for parent in a_tag.iterancestors("article", "li", "div"):
+        return parent
+    return a_tag
 
 def extract_text_nearby(a_tag):
-    container = a_tag.find_parent(["article", "li", "div"]) or a_tag
-    text = " ".join((container.get_text(separator=" ", strip=True) or "").split())
+    container = find_container(a_tag)
+    text = " ".join(" ".join(container.itertext()).split())
     return text[:400]
 
+def _absolute_image_url(src, base_url):
+    if src.startswith("//"):
+        return "https:" + src
+    if src.startswith("/"):
+        return urljoin(base_url, src)
+    return src
+
 def extract_image_nearby(a_tag, base_url):
     """Extract the best quality image URL near a listing link."""
-    container = a_tag.find_parent(["article", "li", "div"]) or a_tag
-    
-    # Find first real img tag (not lazy placeholder)
-    for img in container.find_all("img"):
-        # Prefer data-src (usually higher quality) over src (often placeholder)
-        src = img.get("data-src") or img.get("data-lazy-src") or img.get("src")
-        if src:
-            # Make absolute URL
-            if src.startswith("//"):
-                src = "https:" + src
-            elif src.startswith("/"):
-                src = urljoin(base_url, src)
-            # Skip placeholder/icon/logo images
-            src_lower = src.lower()
-            if ("placeholder" not in src_lower and 
-                "icon" not in src_lower and 
-                "logo" not in src_lower and
-                "avatar" not in src_lower and
-                "data:image" not in src_lower and
-                len(src) > 20):
-                return src
-    
-    # Try background-image in style
-    for elem in container.find_all(style=True):
-        style = elem.get("style", "")
-        match = re.search(r'url\(["\']?([^"\')+]+)["\']?\)', style)
-        if match:
-            src = match.group(1)
-            if src.startswith("//"):
-                src = "https:" + src
-            elif src.startswith("/"):
-                src = urljoin(base_url, src)
-            if "placeholder" not in src.lower():
-                return src
-    
-    return None
+    container = find_container(a_tag)
+
+    # One walk over the container: return the first real <img>, remembering
+    # the first background-image in case there is none
+    background = None
+    for elem in container.iterdescendants(etree.Element):
+        if elem.tag == "img":
+            # Prefer data-src (usually higher quality) over src (often placeholder)
+            src = elem.get("data-src") or elem.get("data-lazy-src") or elem.get("src")
+            if src:
+                src = _absolute_image_url(src, base_url)
+                # Skip placeholder/icon/logo images
+                src_lower = src.lower()
+                if len(src) > 20 and not any(tok in src_lower for tok in _BAD_IMAGE_TOKENS):
+                    return src
+        if background is None:
+            style = elem.get("style")
+            match = _STYLE_URL_RE.search(style) if style else None
+            if match:
+                src = _absolute_image_url(match.group(1), base_url)
+                if "placeholder" not in src.lower():
+                    background = src
+
+    return background
 
 def extract_price(text):
-    m = re.search(r"(\d{3,6})\s*₪", text.replace(",", ""))
+    m = _PRICE_RE.search(text.replace(",", ""))
     if m:
         try:
             return int(m.group(1))
@@ -114,7 +204,7 @@ def extract_price(text):
     return None
 
 def extract_rooms(text):
-    m = re.search(r"(\d+(?:\.\d)?)\s*חדר", text)
+    m = _ROOMS_RE.search(text)
     if m:
         try:
             return float(m.group(1))
@@ -123,7 +213,7 @@ def extract_rooms(text):
     return None
 
 def extract_size(text):
-    m = re.search(r"(\d{2,4})\s*(?:מ\"ר|מטר)", text)
+    m = _SIZE_RE.search(text)
     if m:
         try:
             return int(m.group(1))
@@ -131,91 +221,144 @@ def extract_size(text):
             return None
     return None
 
-def passes_filters(text, filters):
-    kw_inc = filters.get("must_include_keywords") or []
-    kw_exc = filters.get("exclude_keywords") or []
+def prepare_filters(filters):
+    """Normalize the config filters once so passes_filters does no per-link setup."""
     min_rooms = filters.get("min_rooms")
     min_size = filters.get("min_size_sqm")
     max_price = filters.get("max_price_nis")
+    return {
+        "inc": tuple(kw.lower() for kw in filters.get("must_include_keywords") or []),
+        "exc": tuple(kw.lower() for kw in filters.get("exclude_keywords") or []),
+        "min_rooms": float(min_rooms) if min_rooms else None,
+        "min_size": int(min_size) if min_size else None,
+        "max_price": int(max_price) if max_price else None,
+    }
+
+def passes_filters(text, filters):
+    """Check text against filters as returned by prepare_filters."""
+    kw_inc = filters["inc"]
+    kw_exc = filters["exc"]
+    min_rooms = filters["min_rooms"]
+    min_size = filters["min_size"]
+    max_price = filters["max_price"]
 
     t = text or ""
     t_norm = t.lower()
 
+    # map() over the bound method keeps the keyword scan in C
+    contains = t_norm.__contains__
     if kw_inc:
-        if not any(kw.lower() in t_norm for kw in kw_inc):
+        if not any(map(contains, kw_inc)):
             return False
     if kw_exc:
-        if any(kw.lower() in t_norm for kw in kw_exc):
+        if any(map(contains, kw_exc)):
             return False
 
-    rooms = extract_rooms(t)
-    if min_rooms and rooms is not None and rooms < float(min_rooms):
-        return False
+    # Only run the numeric extractors for filters that are configured
+    if min_rooms is not None:
+        rooms = extract_rooms(t)
+        if rooms is not None and rooms < min_rooms:
+            return False
 
-    size = extract_size(t)
-    if min_size and size is not None and size < int(min_size):
-        return False
+    if min_size is not None:
+        size = extract_size(t)
+        if size is not None and size < min_size:
+            return False
 
-    price = extract_price(t)
-    if max_price and price is not None and price > int(max_price):
-        return False
+    if max_price is not None:
+        price = extract_price(t)
+        if price is not None and price > max_price:
+            return False
 
     return True
 
-def fetch_listings_for_source(source, filters):
+def fetch_listings_for_source(source, filters, session=SESSION):
     name = source["name"]
     url = source["url"]
     domain_hint = source.get("domain_hint", None)
 
     try:
-        resp = requests.get(url, timeout=30, headers={
-            "User-Agent": "Mozilla/5.0 (compatible; TelAvivRentalBot/1.0)"
-        })
+        resp = session.get(url, timeout=FETCH_TIMEOUT)
         resp.raise_for_status()
     except Exception as e:
         return name, [], f"שגיאה בטעינת {name}: {e}"
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    links = soup.find_all("a", href=True)
-
+    # Hand lxml the raw bytes: it decodes natively (honouring <meta charset>),
+    # which skips requests' text decoding and charset detection. An explicit
+    # charset in the Content-Type header still takes precedence, unless lxml
+    # does not know it (e.g. "utf8mb4"), in which case <meta charset> decides.
+    parser = None
+    if "charset=" in resp.headers.get("Content-Type", "").lower():
+        try:
+            parser = lxhtml.HTMLParser(encoding=resp.encoding)
+        except LookupError:
+            parser = None
+    try:
+        root = lxhtml.fromstring(resp.content, parser=parser)
+    except (etree.ParserError, ValueError, LookupError) as e:
+        return name, [], f"שגיאה בניתוח {name}: {e}"
+    # Script/style/template bodies are not rendered text; keep them out of
+    # nearby text, as BeautifulSoup's get_text() did
+    etree.strip_elements(root, "script", "style", "template", with_tail=False)
+
+    base = urlsplit(url)
     items = []
-    seen_urls = set()  # Avoid duplicates
-    for a in links:
-        abs_url = normalize_url(url, a.get("href"))
+    seen_urls = set()  # Accepted or non-listing URLs; no need to look at them again
+    resolved = {}  # Raw href -> absolute URL; cards repeat the same href many times
+    for a in root.iter("a"):
+        href = a.get("href")
+        if href in resolved:
+            abs_url = resolved[href]
+        else:
+            abs_url = resolved[href] = normalize_url(url, href, base)
         if not abs_url:
             continue
         if abs_url in seen_urls:
             continue
-        if is_listing_link(abs_url, domain_hint):
-            text = extract_text_nearby(a)
-            if passes_filters(text, filters):
-                image = extract_image_nearby(a, url)
-                items.append({"url": abs_url, "text": text, "image": image})
-                seen_urls.add(abs_url)
+        if not is_listing_link(abs_url, domain_hint):
+            seen_urls.add(abs_url)
+            continue
+        # Filter failures are not cached: another anchor for the same
+        # listing may sit in a container with more descriptive text.
+        text = extract_text_nearby(a)
+        if passes_filters(text, filters):
+            image = extract_image_nearby(a, url)
+            items.append({"url": abs_url, "text": text, "image": image})
+            seen_urls.add(abs_url)
     return name, items, None
 
 def mark_and_filter_new(conn, source_name, items):
+    """Return items whose URL is not in the DB yet, recording them as seen."""
+    keys = [it["url"] for it in items]
+    if not keys:
+        return []
     cur = conn.cursor()
-    new_items = []
     now = datetime.utcnow().isoformat()
 
-    for it in items:
-        key = it["url"]
-        try:
-            cur.execute(
-                "INSERT INTO seen (source_name, listing_key, first_seen_at) VALUES (?, ?, ?)",
-                (source_name, key, now),
-            )
-            new_items.append(it)
-        except sqlite3.IntegrityError:
-            pass
-
-    conn.commit()
+    # Look up only this batch's keys (via the listing_key index) so
+    # already-seen rows are never written again
+    already = set()
+    with conn:
+        for start in range(0, len(keys), SQL_IN_CHUNK):
+            chunk = keys[start:start + SQL_IN_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(f"SELECT listing_key FROM seen WHERE listing_key IN ({placeholders})", chunk)
+            already.update(row[0] for row in cur.fetchall())
+        new_items = [it for it in items if it["url"] not in already]
+        cur.executemany(
+            "INSERT OR IGNORE INTO seen (source_name, listing_key, first_seen_at) VALUES (?, ?, ?)",
+            [(source_name, it["url"], now) for it in new_items],
+        )
     return new_items
 
-def build_email_html(date_str, groups):
-    # Mobile-friendly RTL email layout - stacks on small screens
-    style = """
+_HTML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+def _esc(s):
+    """Escape text for HTML content and double-quoted attributes."""
+    return s.translate(_HTML_ESCAPES)
+
+# Mobile-friendly RTL email layout - stacks on small screens
+_EMAIL_HEAD = """
     <!DOCTYPE html>
     <html dir="rtl" lang="he">
     <head>
@@ -314,10 +457,26 @@ def build_email_html(date_str, groups):
     <body dir="rtl" style="direction:rtl;text-align:right;">
     <div class="container" dir="rtl" align="right">
     """
-    
-    parts = [style]
-    parts.append('<h1 dir="rtl" align="right">🏠 דירות חדשות</h1>')
-    parts.append(f'<div class="subtitle" dir="rtl" align="right">{date_str}</div>')
+
+# Mobile-friendly: image on top, text below
+_LISTING_TPL = '''
+            <a href="{url}" class="listing" target="_blank">
+                {img_html}
+                <div class="listing-content" dir="rtl" align="right">
+                    <div class="listing-text" dir="rtl">{snippet}</div>
+                    <div class="listing-cta">לצפייה במודעה ←</div>
+                </div>
+            </a>
+            '''
+_IMG_TPL = '<img src="{}" class="listing-img" alt="">'
+_NO_IMAGE_HTML = '<div class="no-image">📷 אין תמונה</div>'
+
+def build_email_html(date_str, groups):
+    buf = io.StringIO()
+    write = buf.write
+    write(_EMAIL_HEAD)
+    write('\n<h1 dir="rtl" align="right">🏠 דירות חדשות</h1>')
+    write(f'\n<div class="subtitle" dir="rtl" align="right">{date_str}</div>')
     
     any_items = False
     
@@ -327,38 +486,26 @@ def build_email_html(date_str, groups):
         if not items:
             continue
         any_items = True
-        parts.append(f'<h2 dir="rtl" align="right">{source_name} ({len(items)} מודעות)</h2>')
+        write(f'\n<h2 dir="rtl" align="right">{_esc(source_name)} ({len(items)} מודעות)</h2>')
         
         for it in items:
-            url = it["url"]
             text = it["text"]
             image = it.get("image")
             snippet = (text[:300] + "…") if len(text) > 320 else text
-            
-            # Build image HTML
-            if image:
-                img_html = f'<img src="{image}" class="listing-img" alt="">'
-            else:
-                img_html = '<div class="no-image">📷 אין תמונה</div>'
-            
-            # Mobile-friendly: image on top, text below
-            parts.append(f'''
-            <a href="{url}" class="listing" target="_blank">
-                {img_html}
-                <div class="listing-content" dir="rtl" align="right">
-                    <div class="listing-text" dir="rtl">{snippet}</div>
-                    <div class="listing-cta">לצפייה במודעה ←</div>
-                </div>
-            </a>
-            ''')
+            write("\n")
+            write(_LISTING_TPL.format(
+                url=_esc(it["url"]),
+                img_html=_IMG_TPL.format(_esc(image)) if image else _NO_IMAGE_HTML,
+                snippet=_esc(snippet),
+            ))
 
     if not any_items:
-        parts.append('<div class="empty-msg" dir="rtl">לא נמצאו מודעות חדשות 🔍</div>')
+        write('\n<div class="empty-msg" dir="rtl">לא נמצאו מודעות חדשות 🔍</div>')
     
-    parts.append('<div class="footer">נשלח אוטומטית ע״י Rental Bot</div>')
-    parts.append('</div></body></html>')
+    write('\n<div class="footer">נשלח אוטומטית ע״י Rental Bot</div>')
+    write('\n</div></body></html>')
 
-    return "\n".join(parts)
+    return buf.getvalue()
 
 def send_email(config, subject, html_body):
     from_email = config["email"]["from_email"]
@@ -390,12 +537,21 @@ def main():
     groups = []
     errors = []
 
-    for src in config.get("sources", []):
-        source_name, items, err = fetch_listings_for_source(src, config.get("filters", {}))
+    sources = config.get("sources", [])
+    filters = prepare_filters(config.get("filters", {}))
+    # Fetching is network-bound, so pull all sources concurrently; the DB
+    # connection stays on this thread for marking.
+    workers = max(1, min(MAX_FETCH_WORKERS, len(sources)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(lambda src: fetch_listings_for_source(src, filters), sources))
+
+    for source_name, items, err in results:
         if err:
             errors.append(err)
         new_items = mark_and_filter_new(conn, source_name, items)
         groups.append({"source": source_name, "items": new_items})
+    # Closing checkpoints the WAL back into the single file the workflow caches
+    conn.close()
 
     tz = pytz.timezone("Asia/Jerusalem")
     now = datetime.now(tz)
@@ -404,7 +560,7 @@ def main():
 
     html = build_email_html(today, groups)
     if errors:
-        html += "<hr><p><b>אזהרות:</b><br>" + "<br>".join(errors) + "</p>"
+        html += "<hr><p><b>אזהרות:</b><br>" + "<br>".join(_esc(e) for e in errors) + "</p>"
 
     # Include time in subject to prevent Gmail threading
     subject = f"🏠 דירות חדשות – {today} {time_str}"